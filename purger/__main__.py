@@ -0,0 +1,4 @@
+from purger.main import cli
+
+if __name__ == "__main__":
+    cli()
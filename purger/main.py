@@ -1,163 +1,305 @@
 from __future__ import annotations
 
 import asyncio
+import logging
+import random
 import sys
 import textwrap
+import time
+from collections import deque
+from email.utils import parsedate_to_datetime
 from http import HTTPStatus
+from logging.handlers import QueueHandler, QueueListener
 from pprint import pformat
+from queue import SimpleQueue
+from typing import TYPE_CHECKING, Any, Awaitable, Callable
+from urllib.parse import parse_qs, urlsplit
 
 import click
-import httpx
+import orjson
+
+# httpx is only imported when the orchestrator actually runs, so that
+# things like 'fork-purger --help' don't pay for loading it.
+if TYPE_CHECKING:
+    import httpx
 
 MAX_CONCURRENCY = 5
 
+logger = logging.getLogger(__name__)
+
+BASE_URL = "https://api.github.com"
+USER_REPOS_PATH = "/users/{username}/repos"
+
+# Seconds an idle connection of the shared client is kept alive for.
+KEEPALIVE_EXPIRY = 120
+
+# Seconds to wait on network operations before giving up.
+TIMEOUT = 10.0
+
+# How many times the transport retries a failed connection attempt.
+CONNECT_RETRIES = 2
+
+# How many times a rate limited or failed request is retried.
+MAX_RETRIES = 5
+
+# Plain ints, so that checking a status code is a raw int comparison
+# rather than a trip through the IntEnum machinery.
+RATE_LIMIT_STATUSES = frozenset(
+    {int(HTTPStatus.FORBIDDEN), int(HTTPStatus.TOO_MANY_REQUESTS)}
+)
+NOT_FOUND = int(HTTPStatus.NOT_FOUND)
+SERVER_ERROR = int(HTTPStatus.INTERNAL_SERVER_ERROR)
+
+
+def get_backoff(attempt: int) -> float:
+    """Exponential backoff with jitter, in seconds."""
+
+    return 2**attempt * random.uniform(0.5, 1.5)
+
+
+def parse_retry_after(value: str, attempt: int) -> float:
+    """
+    Turn a `Retry-After` header into seconds to wait. The header holds
+    either a number of seconds or an HTTP-date, anything else falls back
+    to the backoff.
+    """
+
+    try:
+        return float(value)
+    except ValueError:
+        pass
+
+    try:
+        retry_at = parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError):
+        return get_backoff(attempt)
+
+    return max(retry_at - time.time(), 1.0)
+
+
+def get_retry_delay(res: httpx.Response, attempt: int) -> float | None:
+    """
+    Return how many seconds to wait before retrying the request that
+    produced `res`, or `None` if it shouldn't be retried.
+    """
+
+    status_code = res.status_code
+    headers = res.headers
+
+    # Github signals both the primary and the secondary rate limits with a
+    # 403 or a 429 and tells how long to back off via the headers.
+    if status_code in RATE_LIMIT_STATUSES:
+        if "Retry-After" in headers:
+            return parse_retry_after(headers["Retry-After"], attempt)
+        if headers.get("X-RateLimit-Remaining") == "0":
+            reset = float(headers.get("X-RateLimit-Reset", 0))
+            return max(reset - time.time(), 1.0)
+        return None
+
+    if status_code >= SERVER_ERROR:
+        return get_backoff(attempt)
+
+    return None
+
+
+async def send_with_retry(
+    send: Callable[..., Awaitable[httpx.Response]],
+    url: str,
+    **kwargs: Any,
+) -> httpx.Response:
+    """
+    Call `send(url, **kwargs)` and retry with a backoff as long as
+    Github responds with a rate limit or a server error.
+    """
+
+    attempt = 0
+    while True:
+        res = await send(url, **kwargs)
+        delay = get_retry_delay(res, attempt)
+        if delay is None or attempt == MAX_RETRIES:
+            return res
+
+        await asyncio.sleep(delay)
+        attempt += 1
+
 
 async def get_forked_repos(
+    client: httpx.AsyncClient,
     username: str,
-    token: str,
     page: int = 1,
     per_page: int = 100,
-) -> list[str]:
+) -> tuple[list[str], int]:
 
-    """Get the URLs of forked repos in a page."""
+    """
+    Get the URLs of forked repos in a page along with the number of
+    the last page, as advertised by the `Link` response header.
+    """
 
-    url = (
-        f"https://api.github.com/users/{username}/repos"
-        f"?page={page}&per_page={per_page}"
-    )
+    # The REST API can't filter forks on the server. 'type=owner' is the
+    # default for this endpoint and is only passed to make it explicit.
+    params = {"type": "owner", "page": page, "per_page": per_page}
 
-    headers = {
-        "Accept": "application/vnd.github.v3+json",
-        "Authorization": f"Token {token}",
-    }
+    path = USER_REPOS_PATH.format(username=username)
 
-    forked_urls = []  # type: list[str]
-    async with httpx.AsyncClient(http2=True) as client:
-        res = await client.get(url, headers=headers)
+    res = await send_with_retry(client.get, path, params=params)
 
-        if not res.status_code == HTTPStatus.OK:
-            raise Exception(f"{pformat(res.json())}")
+    if not res.is_success:
+        raise Exception(f"{pformat(res.json())}")
 
-        results = res.json()
+    # Github leaves out the 'last' relation when this is the last page.
+    last_page = page
+    last_url = res.links.get("last", {}).get("url")
+    if last_url:
+        last_page = int(parse_qs(urlsplit(last_url).query)["page"][0])
 
-        if not results:
-            return forked_urls
+    results = orjson.loads(res.content)
+    forked_urls = [result["url"] for result in results if result.get("fork")]
 
-        for result in results:
-            if result["fork"] is True:
-                forked_urls.append(result["url"])
+    return forked_urls, last_page
 
-    return forked_urls
 
-
-async def delete_forked_repo(url: str, token: str, delete: bool = False) -> None:
-    headers = {
-        "Accept": "application/vnd.github.v3+json",
-        "Authorization": f"Token {token}",
-    }
+async def delete_forked_repo(
+    client: httpx.AsyncClient,
+    url: str,
+    semaphore: asyncio.Semaphore,
+    delete: bool = False,
+) -> None:
     if not delete:
-        print(url)
+        logger.info(url)
         return None
 
-    client = httpx.AsyncClient(http2=True)
+    attempts = 0
+
+    async def send(url: str) -> httpx.Response:
+        nonlocal attempts
+        attempts += 1
+        return await client.delete(url)
 
-    async with client:
-        print(f"Deleting... {url}")
+    # Caps the number of DELETE requests that are in flight at once.
+    async with semaphore:
+        logger.info("Deleting... %s", url)
+        res = await send_with_retry(send, url)
 
-        res = await client.delete(url, headers=headers)
+    # A DELETE that went through but still answered with a server error
+    # gets a 404 on the retry, as the repo is already gone.
+    if attempts > 1 and res.status_code == NOT_FOUND:
+        return None
 
-        status_code = res.status_code
-        if status_code not in (HTTPStatus.OK, HTTPStatus.NO_CONTENT):
-            raise Exception(f"HTTP error: {res.status_code}.")
+    if not res.is_success:
+        raise Exception(f"HTTP error: {res.status_code}.")
 
 
 async def enqueue(
-    queue: asyncio.Queue[str],
-    event: asyncio.Event,
+    client: httpx.AsyncClient,
+    queue: deque[str | None],
+    data_available: asyncio.Event,
     username: str,
-    token: str,
     stop_after: int | None = None,
 ) -> None:
     """
-    Collects the URLs of all the forked repos and inject them into an
-    async queue.
+    Collects the URLs of all the forked repos and inject them into a
+    deque. Once the pages are exhausted, a `None` sentinel is appended
+    to signal shutdown.
 
     Parameters
     ----------
-    queue : asyncio.Queue[str]
-        Async queue where the forked repo URLs are injected.
-    event : asyncio.Event
-        Async event for coroutine synchronization.
+    client : httpx.AsyncClient
+        Shared HTTP client.
+    queue : deque[str | None]
+        Deque where the forked repo URLs are injected.
+    data_available : asyncio.Event
+        Set whenever new URLs are appended to the deque.
     username : str
         Github username.
-    token : str
-        Github access token.
     stop_after : int | None
-        Stop the while loop after `stop_after` iterations.
+        Stop after fetching `stop_after` pages.
     """
 
-    page = 1
-    while True:
-        forked_urls = await get_forked_repos(
-            username=username,
-            token=token,
-            page=page,
+    # The first page tells how many pages there are. The rest of them are
+    # then fetched concurrently over the shared connection while the URLs
+    # of the first page are being processed.
+    forked_urls, last_page = await get_forked_repos(
+        client=client,
+        username=username,
+    )
+    if stop_after:
+        last_page = min(last_page, stop_after)
+
+    tasks = [
+        asyncio.create_task(
+            get_forked_repos(
+                client=client,
+                username=username,
+                page=page,
+            )
         )
-        if not forked_urls:
-            break
+        for page in range(2, last_page + 1)
+    ]
 
-        for forked_url in forked_urls:
-            await queue.put(forked_url)
+    # A whole page is handed over at once, with a single wakeup.
+    queue.extend(forked_urls)
+    data_available.set()
 
-        if stop_after == page:
-            break
+    # If a page fails, gather doesn't cancel the fetches of the other pages,
+    # so they are cancelled and awaited here before the error propagates.
+    # Otherwise they would outlive the client they're sending requests on.
+    try:
+        pages = await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
 
-        page += 1
-        event.set()
-        await asyncio.sleep(0.3)
+    for forked_urls, _ in pages:
+        queue.extend(forked_urls)
+        data_available.set()
+
+    queue.append(None)
+    data_available.set()
 
 
 async def dequeue(
-    queue: asyncio.Queue[str],
-    event: asyncio.Event,
-    token: str,
+    client: httpx.AsyncClient,
+    queue: deque[str | None],
+    data_available: asyncio.Event,
+    semaphore: asyncio.Semaphore,
     delete: bool,
-    stop_after: int | None = None,
 ) -> None:
     """
-    Collects forked repo URLs from the async queue and deletes
-    them concurrently.
+    Collects forked repo URLs from the deque and deletes them one
+    by one. Several of these run side by side as a pool of consumers.
+    Returns when the `None` sentinel is popped off.
 
     Parameters
     ----------
-    queue : asyncio.Queue[str]
-        Async queue where the forked repo URLs are popped off.
-    event : asyncio.Event
-        Async event for coroutine synchronization.
-    token : str
-        Github access token.
+    client : httpx.AsyncClient
+        Shared HTTP client.
+    queue : deque[str | None]
+        Deque where the forked repo URLs are popped off.
+    data_available : asyncio.Event
+        Set by the producer whenever new URLs are appended to the deque.
+    semaphore : asyncio.Semaphore
+        Caps the number of in-flight DELETE requests.
     delete : bool
         Whether to delete the forked repos or not.
-    stop_after : asyncio.Event
-        Stop the while loop after `stop_after` iterations.
     """
-    cnt = 0
-    while True:
-        await event.wait()
-
-        forked_url = await queue.get()
-
-        await delete_forked_repo(forked_url, token, delete)
-
-        # Yields control to the event loop.
-        await asyncio.sleep(0)
-
-        queue.task_done()
-        cnt += 1
 
-        if stop_after and stop_after == cnt:
+    while True:
+        if not queue:
+            data_available.clear()
+            await data_available.wait()
+            continue
+
+        forked_url = queue.popleft()
+        if forked_url is None:
+            # Leave the sentinel in place for the other consumers.
+            queue.appendleft(None)
+            data_available.set()
             break
 
+        await delete_forked_repo(client, forked_url, semaphore, delete)
+
 
 async def orchestrator(username: str, token: str, delete: bool) -> None:
     """
@@ -165,60 +307,66 @@ async def orchestrator(username: str, token: str, delete: bool) -> None:
     producer-consumer setup.
     """
 
-    queue = asyncio.Queue()  # type: asyncio.Queue[str]
-    event = asyncio.Event()  # type: asyncio.Event
+    import httpx
 
-    enqueue_task = asyncio.create_task(enqueue(queue, event, username, token))
+    queue = deque()  # type: deque[str | None]
+    data_available = asyncio.Event()
 
-    dequeue_tasks = [
-        asyncio.create_task(dequeue(queue, event, token, delete))
-        for _ in range(MAX_CONCURRENCY)
-    ]
+    # Created here so that it's bound to the running event loop.
+    semaphore = asyncio.Semaphore(MAX_CONCURRENCY)
 
-    dequeue_tasks.append(enqueue_task)
+    # Attached to every request made by the client.
+    headers = {
+        "Accept": "application/vnd.github.v3+json",
+        "Authorization": f"Token {token}",
+        "User-Agent": "fork-purger",
+    }
 
-    done, pending = await asyncio.wait(
-        dequeue_tasks,
-        return_when=asyncio.FIRST_COMPLETED,
+    # A single client is shared across the run so that every request reuses
+    # the same pooled HTTP/2 connection instead of doing a fresh TCP + TLS
+    # handshake. Over HTTP/2 all the requests get multiplexed on one
+    # long-lived connection, the extra ones only come into play if the
+    # server falls back to HTTP/1.1.
+    limits = httpx.Limits(
+        max_keepalive_connections=MAX_CONCURRENCY,
+        max_connections=MAX_CONCURRENCY,
+        keepalive_expiry=KEEPALIVE_EXPIRY,
+    )
+    transport = httpx.AsyncHTTPTransport(
+        http2=True,
+        limits=limits,
+        retries=CONNECT_RETRIES,
     )
 
-    for fut in done:
-        try:
-            exc = fut.exception()
-            if exc:
-                raise exc
-        except asyncio.exceptions.InvalidStateError:
-            pass
-
-    for t in pending:
-        t.cancel()
+    async with httpx.AsyncClient(
+        base_url=BASE_URL,
+        headers=headers,
+        timeout=TIMEOUT,
+        transport=transport,
+    ) as client:
+        # One producer and a fixed pool of consumers for the whole run.
+        tasks = [
+            asyncio.create_task(enqueue(client, queue, data_available, username)),
+        ]
+        tasks.extend(
+            asyncio.create_task(
+                dequeue(client, queue, data_available, semaphore, delete)
+            )
+            for _ in range(MAX_CONCURRENCY)
+        )
 
-    # This runs the 'enqueue' function implicitly.
-    await queue.join()
+        # All the tasks run to completion unless one of them fails. In that
+        # case the others are cancelled and awaited before the client gets
+        # closed, and the original error is propagated.
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
 
 
-@click.command()
-@click.option(
-    "--username",
-    help="Your Github username.",
-    required=True,
-)
-@click.option(
-    "--token",
-    help="Your Github access token with delete permission.",
-    required=True,
-)
-@click.option(
-    "--debug/--no-debug",
-    default=False,
-    help="See full traceback in case of HTTP error.",
-)
-@click.option(
-    "--delete",
-    is_flag=True,
-    default=False,
-    help="Delete the forked repos.",
-)
 def _cli(username: str, token: str, debug: bool, delete: bool) -> None:
     if debug is False:
         sys.tracebacklimit = 0
@@ -231,7 +379,71 @@ def _cli(username: str, token: str, debug: bool, delete: bool) -> None:
         click.echo("Deleting forked repos:")
         click.echo("=======================\n")
 
-    asyncio.run(orchestrator(username, token, delete))
+    # uvloop is optional. Fall back to the default event loop without it.
+    try:
+        import uvloop
+    except ImportError:
+        pass
+    else:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+    # The per-repo log records are written to stdout from a background
+    # thread, so the event loop never blocks on the terminal.
+    records = SimpleQueue()  # type: SimpleQueue[logging.LogRecord]
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(logging.Formatter("%(message)s"))
+    listener = QueueListener(records, stream_handler)
+
+    # The level is only set for the duration of the run, so that importing
+    # the module leaves the logger alone.
+    level = logger.level
+    logger.setLevel(logging.INFO)
+
+    queue_handler = QueueHandler(records)
+    logger.addHandler(queue_handler)
+    listener.start()
+
+    try:
+        asyncio.run(orchestrator(username, token, delete))
+    finally:
+        listener.stop()
+        logger.removeHandler(queue_handler)
+        logger.setLevel(level)
+
+
+def _make_cli() -> click.Command:
+    """
+    Build the click command around `_cli`. Doing it here rather than
+    with decorators keeps importing the module free of side effects.
+    """
+
+    return click.Command(
+        "fork-purger",
+        callback=_cli,
+        params=[
+            click.Option(
+                ["--username"],
+                help="Your Github username.",
+                required=True,
+            ),
+            click.Option(
+                ["--token"],
+                help="Your Github access token with delete permission.",
+                required=True,
+            ),
+            click.Option(
+                ["--debug/--no-debug"],
+                default=False,
+                help="See full traceback in case of HTTP error.",
+            ),
+            click.Option(
+                ["--delete"],
+                is_flag=True,
+                default=False,
+                help="Delete the forked repos.",
+            ),
+        ],
+    )
 
 
 def cli() -> None:
@@ -243,7 +455,7 @@ def cli() -> None:
         """
     )
     click.echo(greet_text)
-    _cli()
+    _make_cli()()
 
 
 if __name__ == "__main__":
@@ -1,9 +1,12 @@
 import asyncio
-import importlib
+import logging
+import sys
 import textwrap
+from collections import deque
 from http import HTTPStatus
-from unittest.mock import patch  # Requires Python 3.8+.
+from unittest.mock import AsyncMock, MagicMock, patch  # Requires Python 3.8+.
 
+import httpx
 import pytest
 from click.testing import CliRunner
 from httpx import Response
@@ -11,37 +14,59 @@ from httpx import Response
 import purger.main as purger
 
 
-@patch.object(purger.httpx.AsyncClient, "get", autospec=True)
+@patch.object(httpx.AsyncClient, "get", new_callable=AsyncMock)
 async def test_get_forked_repos_ok(mock_async_get):
     mock_async_get.return_value = Response(
         status_code=HTTPStatus.OK,
+        json=[{"fork": True, "url": "https://dummy_url.com"}],
     )
-    mock_async_get.return_value.json = lambda: [
-        {"fork": True, "url": "https://dummy_url.com"}
-    ]
 
     result = await purger.get_forked_repos(
+        client=httpx.AsyncClient(),
         username="dummy_username",
-        token="dummy_token",
     )
-    assert result == ["https://dummy_url.com"]
+    assert result == (["https://dummy_url.com"], 1)
+    mock_async_get.assert_awaited_once_with(
+        "/users/dummy_username/repos",
+        params={"type": "owner", "page": 1, "per_page": 100},
+    )
 
 
-@patch.object(purger.httpx.AsyncClient, "get", autospec=True)
+@patch.object(httpx.AsyncClient, "get", new_callable=AsyncMock)
 async def test_get_forked_repos_empty(mock_async_get):
     mock_async_get.return_value = Response(
         status_code=HTTPStatus.OK,
+        json=[],
     )
-    mock_async_get.return_value.json = lambda: []
 
     result = await purger.get_forked_repos(
+        client=httpx.AsyncClient(),
+        username="dummy_username",
+    )
+    assert result == ([], 1)
+
+
+@patch.object(httpx.AsyncClient, "get", new_callable=AsyncMock)
+async def test_get_forked_repos_last_page(mock_async_get):
+    mock_async_get.return_value = Response(
+        status_code=HTTPStatus.OK,
+        headers={
+            "Link": (
+                '<https://api.github.com/user/repos?page=2&per_page=100>; rel="next", '
+                '<https://api.github.com/user/repos?page=7&per_page=100>; rel="last"'
+            )
+        },
+        json=[{"fork": True, "url": "https://dummy_url.com"}],
+    )
+
+    result = await purger.get_forked_repos(
+        client=httpx.AsyncClient(),
         username="dummy_username",
-        token="dummy_token",
     )
-    assert result == []
+    assert result == (["https://dummy_url.com"], 7)
 
 
-@patch.object(purger.httpx.AsyncClient, "get", autospec=True)
+@patch.object(httpx.AsyncClient, "get", new_callable=AsyncMock)
 async def test_get_forked_repos_error(mock_async_get):
     mock_async_get.return_value = Response(
         status_code=HTTPStatus.FORBIDDEN,
@@ -50,14 +75,16 @@ async def test_get_forked_repos_error(mock_async_get):
 
     with pytest.raises(Exception):
         result = await purger.get_forked_repos(
+            client=httpx.AsyncClient(),
             username="dummy_username",
-            token="dummy_token",
         )
         assert result == []
 
 
-@patch.object(purger.httpx.AsyncClient, "delete", autospec=True)
-async def test_delete_forked_repo_ok(mock_async_delete, capsys):
+@patch.object(httpx.AsyncClient, "delete", new_callable=AsyncMock)
+async def test_delete_forked_repo_ok(mock_async_delete, caplog):
+    caplog.set_level(logging.INFO, logger=purger.logger.name)
+
     # Test dry run ok.
     mock_async_delete.return_value = Response(
         status_code=HTTPStatus.OK,
@@ -65,30 +92,32 @@ async def test_delete_forked_repo_ok(mock_async_delete, capsys):
     mock_async_delete.return_value.json = lambda: []
 
     result = await purger.delete_forked_repo(
+        client=httpx.AsyncClient(),
         url="https://dummy_url.com",
-        token="dummy_token",
+        semaphore=asyncio.Semaphore(1),
     )
-    out, err = capsys.readouterr()
 
     assert result is None
-    assert err == ""
-    assert "https://dummy_url.com" in out
+    assert "https://dummy_url.com" in caplog.text
+    assert "Deleting..." not in caplog.text
+    caplog.clear()
 
     # Test delete ok.
     result = await purger.delete_forked_repo(
+        client=httpx.AsyncClient(),
         url="https://dummy_url.com",
-        token="dummy_token",
+        semaphore=asyncio.Semaphore(1),
         delete=True,
     )
-    out, err = capsys.readouterr()
 
     assert result is None
-    assert err == ""
-    assert "Deleting..." in out
+    assert "Deleting... https://dummy_url.com" in caplog.text
 
 
-@patch.object(purger.httpx.AsyncClient, "delete", autospec=True)
-async def test_delete_forked_repo_error(mock_async_delete, capsys):
+@patch.object(httpx.AsyncClient, "delete", new_callable=AsyncMock)
+async def test_delete_forked_repo_error(mock_async_delete, caplog):
+    caplog.set_level(logging.INFO, logger=purger.logger.name)
+
     mock_async_delete.return_value = Response(
         status_code=HTTPStatus.FORBIDDEN,
     )
@@ -97,91 +126,330 @@ async def test_delete_forked_repo_error(mock_async_delete, capsys):
     # Test delete error.
     with pytest.raises(Exception):
         await purger.delete_forked_repo(
+            client=httpx.AsyncClient(),
             url="https://dummy_url.com",
-            token="dummy_token",
+            semaphore=asyncio.Semaphore(1),
             delete=True,
         )
-    out, err = capsys.readouterr()
 
-    assert err == ""
-    assert "Deleting..." in out
+    assert "Deleting..." in caplog.text
+
+
+@patch("purger.main.asyncio.sleep", new_callable=AsyncMock)
+@patch.object(httpx.AsyncClient, "delete", new_callable=AsyncMock)
+async def test_delete_forked_repo_retry(mock_async_delete, mock_sleep):
+    mock_async_delete.side_effect = [
+        Response(
+            status_code=HTTPStatus.FORBIDDEN,
+            headers={"X-RateLimit-Remaining": "0", "Retry-After": "3"},
+        ),
+        Response(status_code=HTTPStatus.BAD_GATEWAY),
+        Response(status_code=HTTPStatus.NO_CONTENT),
+    ]
+
+    await purger.delete_forked_repo(
+        client=httpx.AsyncClient(),
+        url="https://dummy_url.com",
+        semaphore=asyncio.Semaphore(1),
+        delete=True,
+    )
+
+    assert mock_async_delete.await_count == 3
+    assert mock_sleep.await_count == 2
+    assert mock_sleep.await_args_list[0].args == (3.0,)
+
+
+@patch("purger.main.asyncio.sleep", new_callable=AsyncMock)
+@patch.object(httpx.AsyncClient, "delete", new_callable=AsyncMock)
+async def test_delete_forked_repo_retry_not_found(mock_async_delete, mock_sleep):
+    # The first DELETE went through, so the retry finds the repo gone.
+    mock_async_delete.side_effect = [
+        Response(status_code=HTTPStatus.BAD_GATEWAY),
+        Response(status_code=HTTPStatus.NOT_FOUND),
+    ]
+
+    result = await purger.delete_forked_repo(
+        client=httpx.AsyncClient(),
+        url="https://dummy_url.com",
+        semaphore=asyncio.Semaphore(1),
+        delete=True,
+    )
+
+    assert result is None
+    assert mock_async_delete.await_count == 2
 
+    # Without a retry, a 404 is still an error.
+    mock_async_delete.side_effect = None
+    mock_async_delete.return_value = Response(status_code=HTTPStatus.NOT_FOUND)
 
-@patch.object(purger.httpx.AsyncClient, "get", autospec=True)
+    with pytest.raises(Exception, match="404"):
+        await purger.delete_forked_repo(
+            client=httpx.AsyncClient(),
+            url="https://dummy_url.com",
+            semaphore=asyncio.Semaphore(1),
+            delete=True,
+        )
+
+
+@patch("purger.main.asyncio.sleep", new_callable=AsyncMock)
+@patch.object(httpx.AsyncClient, "delete", new_callable=AsyncMock)
+async def test_delete_forked_repo_retry_exhausted(mock_async_delete, mock_sleep):
+    mock_async_delete.return_value = Response(
+        status_code=HTTPStatus.SERVICE_UNAVAILABLE,
+    )
+
+    with pytest.raises(Exception, match="503"):
+        await purger.delete_forked_repo(
+            client=httpx.AsyncClient(),
+            url="https://dummy_url.com",
+            semaphore=asyncio.Semaphore(1),
+            delete=True,
+        )
+
+    assert mock_async_delete.await_count == purger.MAX_RETRIES + 1
+    assert mock_sleep.await_count == purger.MAX_RETRIES
+
+
+@patch("purger.main.time.time", return_value=1_000_000_000)
+def test_get_retry_delay_retry_after(_):
+    def too_many_requests(retry_after):
+        return Response(
+            status_code=HTTPStatus.TOO_MANY_REQUESTS,
+            headers={"Retry-After": retry_after},
+        )
+
+    assert purger.get_retry_delay(too_many_requests("3"), attempt=0) == 3.0
+
+    # An HTTP-date is turned into the seconds left until then.
+    res = too_many_requests("Sun, 09 Sep 2001 01:47:40 GMT")
+    assert purger.get_retry_delay(res, attempt=0) == 60.0
+
+    # Anything else falls back to the backoff instead of raising.
+    delay = purger.get_retry_delay(too_many_requests("soon"), attempt=2)
+    assert 2.0 <= delay <= 6.0
+
+
+@patch.object(httpx.AsyncClient, "get", new_callable=AsyncMock)
 async def test_enqueue_ok(mock_async_get):
     mock_async_get.return_value = Response(
         status_code=HTTPStatus.OK,
+        json=[
+            {"fork": True, "url": "https://dummy_url_1.com"},
+            {"fork": True, "url": "https://dummy_url_2.com"},
+        ],
     )
-    mock_async_get.return_value.json = lambda: [
-        {"fork": True, "url": "https://dummy_url_1.com"},
-        {"fork": True, "url": "https://dummy_url_2.com"},
-    ]
 
-    queue = asyncio.Queue()
-    event = asyncio.Event()
+    queue = deque()
+    data_available = asyncio.Event()
 
     result = await purger.enqueue(
+        client=httpx.AsyncClient(),
         queue=queue,
-        event=event,
+        data_available=data_available,
         username="dummy_username",
-        token="dummy_token",
         stop_after=1,
     )
     assert result is None
-    assert queue.qsize() == 2
-    assert event.is_set() is False
+
+    # Two URLs followed by the sentinel.
+    assert list(queue) == [
+        "https://dummy_url_1.com",
+        "https://dummy_url_2.com",
+        None,
+    ]
+    assert data_available.is_set() is True
 
 
-@patch("purger.main.delete_forked_repo", autospec=True)
-async def test_dequeue_ok(mock_delete_forked_repo):
-    mock_delete_forked_repo.return_value = None
+@patch("purger.main.get_forked_repos", autospec=True)
+async def test_enqueue_paginated(mock_get_forked_repos):
+    async def get_page(client, username, page=1, per_page=100):
+        return [f"https://dummy_url_{page}.com"], 3
 
-    queue = asyncio.Queue()
-    event = asyncio.Event()
-    queue.put_nowait("https://dummy_url_1.com")
-    queue.put_nowait("https://dummy_url_2.com")
+    mock_get_forked_repos.side_effect = get_page
 
-    event.set()
+    queue = deque()
 
-    result = await purger.dequeue(
+    await purger.enqueue(
+        client=httpx.AsyncClient(),
         queue=queue,
-        event=event,
-        token="dummy_token",
-        delete=False,
-        stop_after=2,
+        data_available=asyncio.Event(),
+        username="dummy_username",
+    )
+
+    assert mock_get_forked_repos.await_count == 3
+    assert list(queue) == [
+        "https://dummy_url_1.com",
+        "https://dummy_url_2.com",
+        "https://dummy_url_3.com",
+        None,
+    ]
+
+
+@patch.object(httpx.AsyncClient, "get", new_callable=AsyncMock)
+async def test_enqueue_link_pagination(mock_async_get):
+    mock_async_get.side_effect = [
+        Response(
+            status_code=HTTPStatus.OK,
+            headers={
+                "Link": (
+                    '<https://api.github.com/user/repos?page=2>; rel="next", '
+                    '<https://api.github.com/user/repos?page=2>; rel="last"'
+                )
+            },
+            json=[
+                {"fork": True, "url": "https://dummy_url_1.com"},
+                {"fork": False, "url": "https://dummy_url_2.com"},
+            ],
+        ),
+        Response(
+            status_code=HTTPStatus.OK,
+            json=[{"fork": True, "url": "https://dummy_url_3.com"}],
+        ),
+    ]
+
+    queue = deque()
+
+    await purger.enqueue(
+        client=httpx.AsyncClient(),
+        queue=queue,
+        data_available=asyncio.Event(),
+        username="dummy_username",
     )
 
+    # No extra request is made to probe for an empty page.
+    assert mock_async_get.await_count == 2
+    assert mock_async_get.await_args.kwargs["params"]["page"] == 2
+    assert list(queue) == ["https://dummy_url_1.com", "https://dummy_url_3.com", None]
+
+
+async def get_page_or_fail(url, params):
+    """Serve 5 pages where page 2 fails and pages 3 to 5 hang."""
+
+    page = params["page"]
+    if page == 1:
+        return Response(
+            status_code=HTTPStatus.OK,
+            headers={"Link": '<https://api.github.com/user/repos?page=5>; rel="last"'},
+            json=[{"fork": True, "url": "https://dummy_url_1.com"}],
+        )
+    if page == 2:
+        return Response(
+            status_code=HTTPStatus.NOT_FOUND,
+            json={"message": "Not Found"},
+        )
+
+    await asyncio.sleep(10)
+    return Response(status_code=HTTPStatus.OK, json=[])
+
+
+@patch.object(httpx.AsyncClient, "get", new_callable=AsyncMock)
+async def test_enqueue_error(mock_async_get):
+    mock_async_get.side_effect = get_page_or_fail
+
+    queue = deque()
+
+    with pytest.raises(Exception, match="Not Found"):
+        await purger.enqueue(
+            client=httpx.AsyncClient(),
+            queue=queue,
+            data_available=asyncio.Event(),
+            username="dummy_username",
+        )
+
+    # The fetches of the other pages are cancelled along with it.
+    assert mock_async_get.await_count == 5
+    assert asyncio.all_tasks() == {asyncio.current_task()}
+
+    # No sentinel is appended after a failure.
+    assert list(queue) == ["https://dummy_url_1.com"]
+
+
+@pytest.mark.parametrize("n", [2, 10_000])
+@patch("purger.main.delete_forked_repo", autospec=True)
+async def test_dequeue_ok(mock_delete_forked_repo, n):
+    mock_delete_forked_repo.return_value = None
+
+    queue = deque()
+    data_available = asyncio.Event()
+
+    # The consumer starts out on an empty deque and waits for the producer.
+    task = asyncio.create_task(
+        purger.dequeue(
+            client=httpx.AsyncClient(),
+            queue=queue,
+            data_available=data_available,
+            semaphore=asyncio.Semaphore(1),
+            delete=False,
+        )
+    )
+    await asyncio.sleep(0)
+
+    queue.extend(f"https://dummy_url_{i}.com" for i in range(n))
+    queue.append(None)
+    data_available.set()
+
+    result = await task
+
     assert result is None
-    assert queue.qsize() == 0
-    assert event.is_set() is True
+    assert mock_delete_forked_repo.await_count == n
+
+    # The sentinel is left behind for the other consumers.
+    assert list(queue) == [None]
+
+
+@patch("purger.main.delete_forked_repo", autospec=True)
+async def test_dequeue_error(mock_delete_forked_repo):
+    mock_delete_forked_repo.side_effect = Exception("HTTP error: 403.")
+
+    queue = deque(["https://dummy_url_1.com", None])
+
+    with pytest.raises(Exception, match="403"):
+        await purger.dequeue(
+            client=httpx.AsyncClient(),
+            queue=queue,
+            data_available=asyncio.Event(),
+            semaphore=asyncio.Semaphore(1),
+            delete=True,
+        )
+
+
+@patch.object(httpx.AsyncClient, "delete", new_callable=AsyncMock)
+async def test_dequeue_concurrency(mock_async_delete):
+    in_flight = max_in_flight = 0
+
+    async def delete(url):
+        nonlocal in_flight, max_in_flight
+        in_flight += 1
+        max_in_flight = max(max_in_flight, in_flight)
+        await asyncio.sleep(0)
+        in_flight -= 1
+        return Response(status_code=HTTPStatus.NO_CONTENT)
+
+    mock_async_delete.side_effect = delete
+
+    queue = deque(f"https://dummy_url_{i}.com" for i in range(100))
+    queue.append(None)
+
+    client = httpx.AsyncClient()
+    data_available = asyncio.Event()
+    semaphore = asyncio.Semaphore(purger.MAX_CONCURRENCY)
+
+    # Twice as many consumers as the semaphore lets through.
+    await asyncio.gather(
+        *(
+            purger.dequeue(client, queue, data_available, semaphore, delete=True)
+            for _ in range(purger.MAX_CONCURRENCY * 2)
+        )
+    )
+
+    assert mock_async_delete.await_count == 100
+    assert max_in_flight == purger.MAX_CONCURRENCY
 
 
-@patch("purger.main.MAX_CONCURRENCY", default=1)
 @patch("purger.main.enqueue", autospec=True)
 @patch("purger.main.dequeue", autospec=True)
-@patch("purger.main.asyncio.Queue", autospec=True)
-@patch("purger.main.asyncio.Event", autospec=True)
-@patch("purger.main.asyncio.create_task", autospec=True)
-@patch("purger.main.asyncio.wait", autospec=True)
-async def test_orchestrator_ok(
-    mock_wait,
-    mock_create_task,
-    mock_event,
-    mock_queue,
-    mock_dequeue,
-    mock_enqueue,
-    _,
-):
-
-    # Mocked futures.
-    done_future = asyncio.Future()
-    done_future.set_result(42)
-    await done_future
-
-    pending_future = asyncio.Future()
-    done_futures, pending_futures = [done_future], [pending_future]
-
-    mock_wait.return_value = (done_futures, pending_futures)
+@patch("httpx.AsyncHTTPTransport", wraps=httpx.AsyncHTTPTransport)
+async def test_orchestrator_ok(mock_transport, mock_dequeue, mock_enqueue):
 
     # Called the mocked function.
     await purger.orchestrator(
@@ -191,26 +459,77 @@ async def test_orchestrator_ok(
     )
 
     # Assert.
-    mock_queue.assert_called_once()
-    mock_queue().join.assert_called_once()
-    mock_event.assert_called_once()
-    mock_create_task.assert_called()
-    mock_wait.assert_awaited_once()
-    mock_enqueue.assert_called_once()
-    mock_dequeue.assert_called_once()
+    mock_enqueue.assert_awaited_once()
+    assert mock_dequeue.await_count == purger.MAX_CONCURRENCY
 
+    # Every request is multiplexed over the same HTTP/2 connection.
+    mock_transport.assert_called_once()
+    assert mock_transport.call_args.kwargs["http2"] is True
+
+    client = mock_enqueue.await_args.args[0]
+    assert client is mock_dequeue.await_args.args[0]
+    assert client.headers["Authorization"] == "Token dummy_token"
+    assert client.headers["User-Agent"] == "fork-purger"
+    assert client.base_url == purger.BASE_URL
+
+
+@patch("purger.main.enqueue", autospec=True)
+@patch("purger.main.dequeue", autospec=True)
+async def test_orchestrator_error(mock_dequeue, mock_enqueue):
+    enqueue_cancelled = asyncio.Event()
 
-@patch("purger.main.orchestrator", autospec=True)
+    async def slow_enqueue(*args, **kwargs):
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            enqueue_cancelled.set()
+            raise
+
+    mock_enqueue.side_effect = slow_enqueue
+    mock_dequeue.side_effect = Exception("HTTP error: 403.")
+
+    with pytest.raises(Exception, match="403"):
+        await purger.orchestrator(
+            username="dummy_username",
+            token="dummy_token",
+            delete=True,
+        )
+
+    # The failing consumer takes the producer down with it, and no task is
+    # left pending once the orchestrator returns.
+    assert enqueue_cancelled.is_set()
+    assert asyncio.all_tasks() == {asyncio.current_task()}
+
+
+@patch.object(httpx.AsyncClient, "get", new_callable=AsyncMock)
+async def test_orchestrator_page_error(mock_async_get):
+    mock_async_get.side_effect = get_page_or_fail
+
+    with pytest.raises(Exception, match="Not Found"):
+        await purger.orchestrator(
+            username="dummy_username",
+            token="dummy_token",
+            delete=False,
+        )
+
+    # The real producer fails on a later page while the others are still
+    # being fetched. None of them outlive the orchestrator.
+    assert mock_async_get.await_count == 5
+    assert asyncio.all_tasks() == {asyncio.current_task()}
+
+
+@patch("purger.main.orchestrator", new_callable=MagicMock)
 @patch("purger.main.asyncio.run", autospec=True)
-def test__cli(mock_asyncio_run, mock_orchestrator):
+@patch("purger.main.asyncio.set_event_loop_policy", autospec=True)
+def test__cli(_, mock_asyncio_run, mock_orchestrator):
     runner = CliRunner()
 
     # Test cli without any arguments.
-    result = runner.invoke(purger._cli, [])
+    result = runner.invoke(purger._make_cli(), [])
     assert result.exit_code != 0
 
     result = runner.invoke(
-        purger._cli,
+        purger._make_cli(),
         ["--username=dummy_username", "--token=dummy_token"],
     )
     assert result.exit_code == 0
@@ -218,7 +537,7 @@ def test__cli(mock_asyncio_run, mock_orchestrator):
     mock_asyncio_run.assert_called_once()
 
     result = runner.invoke(
-        purger._cli,
+        purger._make_cli(),
         ["--username=dummy_username", "--token=dummy_token", "--no-debug"],
     )
     assert result.exit_code == 0
@@ -226,7 +545,7 @@ def test__cli(mock_asyncio_run, mock_orchestrator):
     mock_asyncio_run.assert_called()
 
     result = runner.invoke(
-        purger._cli,
+        purger._make_cli(),
         ["--username=dummy_username", "--token=dummy_token", "--delete"],
     )
     assert result.exit_code == 0
@@ -234,19 +553,54 @@ def test__cli(mock_asyncio_run, mock_orchestrator):
     mock_asyncio_run.assert_called()
 
 
-@patch("purger.main.click.command", autospec=True)
-@patch("purger.main.click.option", autospec=True)
-@patch("purger.main._cli", autospec=True)
-def test_dummy_cli(mock_cli, mock_click_option, mock_click_command, capsys):
+@patch("purger.main.orchestrator", new_callable=MagicMock)
+@patch("purger.main.asyncio.run", autospec=True)
+@patch("purger.main.asyncio.set_event_loop_policy", autospec=True)
+def test__cli_output(_, mock_asyncio_run, mock_orchestrator):
+    mock_asyncio_run.side_effect = lambda _: purger.logger.info("dummy_url")
+    runner = CliRunner()
 
-    # Decorators are executed during import time. So for the 'patch' to work,
-    # the module needs to be reloaded.
-    importlib.reload(purger)
+    result = runner.invoke(
+        purger._make_cli(),
+        ["--username=dummy_username", "--token=dummy_token"],
+    )
 
-    # Since we're invoking the cli function without any parameter, it should
-    # exit with an error code > 0.
+    # The log records are flushed to stdout before the command returns.
+    assert result.exit_code == 0
+    assert result.output.endswith("dummy_url\n")
+    assert not any(isinstance(h, purger.QueueHandler) for h in purger.logger.handlers)
+    assert purger.logger.level == logging.NOTSET
+
+
+@patch("purger.main.orchestrator", new_callable=MagicMock)
+@patch("purger.main.asyncio.run", autospec=True)
+@patch("purger.main.asyncio.set_event_loop_policy", autospec=True)
+def test__cli_uvloop(mock_set_policy, mock_asyncio_run, _):
+    runner = CliRunner()
+    args = ["--username=dummy_username", "--token=dummy_token"]
+
+    # Use uvloop when it's installed.
+    mock_uvloop = MagicMock()
+    with patch.dict(sys.modules, {"uvloop": mock_uvloop}):
+        result = runner.invoke(purger._make_cli(), args)
+
+    assert result.exit_code == 0
+    mock_set_policy.assert_called_once_with(mock_uvloop.EventLoopPolicy())
+    mock_asyncio_run.assert_called_once()
+
+    # Fall back to the default event loop otherwise.
+    mock_set_policy.reset_mock()
+    with patch.dict(sys.modules, {"uvloop": None}):
+        result = runner.invoke(purger._make_cli(), args)
+
+    assert result.exit_code == 0
+    mock_set_policy.assert_not_called()
+
+
+@patch("purger.main._make_cli", autospec=True)
+def test_dummy_cli(mock_make_cli, capsys):
     purger.cli()
-    err, out = capsys.readouterr()
+    out, err = capsys.readouterr()
 
     # Test greeting message.
     greet_msg = textwrap.dedent(
@@ -257,5 +611,17 @@ def test_dummy_cli(mock_cli, mock_click_option, mock_click_command, capsys):
         """
     )
 
-    assert greet_msg in err
-    assert out == ""
+    assert greet_msg in out
+    assert err == ""
+    mock_make_cli.assert_called_once()
+    mock_make_cli.return_value.assert_called_once()
+
+
+def test_make_cli():
+    runner = CliRunner()
+
+    result = runner.invoke(purger._make_cli(), ["--help"])
+
+    assert result.exit_code == 0
+    for option in ("--username", "--token", "--debug / --no-debug", "--delete"):
+        assert option in result.output